@@ -22,6 +22,8 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import codecs
+import struct
 import sys
 from argparse import ArgumentParser
 from dataclasses import dataclass
@@ -41,9 +43,20 @@ FRAME_SIZE = 128  # 128 bytes per frame (64 frames total)
 # 000000A3h - Free   ;deleted (last block of file)
 FIRST = 0x51
 
+# Layout of a 128 bytes directory frame:
+# 00h-03h Block Allocation State
+# 04h-07h Filesize in bytes (only the lower 3 bytes are used)
+# 08h     Pointer to the next block
+# 0Ah-1Eh Filename in Shift JIS, zero padded
+DIRECTORY_FRAME = struct.Struct("<IIBx21s97x")
+
+# Text on the card is Shift JIS, look the codec up once rather than on every decode.
+# Like all codec decoders it returns a (str, consumed) tuple and accepts memoryviews.
+decode_shift_jis = codecs.lookup("shift_jis").decode
+
 
 # A container to store directory information.
-@dataclass
+@dataclass(slots=True)
 class DirectoryFrame:
     state: int
     file_size: int = 0
@@ -51,26 +64,31 @@ class DirectoryFrame:
     file_name: str = None
 
 
-def read_block(data: bytes, i: int):
-    """Returns the subarray of data including only the requested block."""
+def read_block(data: bytes | memoryview, i: int):
+    """
+    Returns the subarray of data including only the requested block.
+
+    Pass a memoryview to get a zero-copy view instead of a new bytes object.
+    """
     return data[i * BLOCK_SIZE : i * BLOCK_SIZE + BLOCK_SIZE]
 
 
-def parse_header(data: bytes) -> list[DirectoryFrame]:
+def parse_header(data: bytes | memoryview) -> list[DirectoryFrame]:
     directories = []
 
-    # Explanation of the range:
-    # • Start at FRAME_SIZE (skipping the header frame)
-    # • Go until we reach 16 frames
-    # • Jump FRAME_SIZE steps so each iteration is a frame.
-    for i in range(FRAME_SIZE, 16 * FRAME_SIZE, FRAME_SIZE):
-        frame = DirectoryFrame(int.from_bytes(data[i : i + 4], "little"))
+    # Skip the header frame and unpack the 15 directory frames that follow it.
+    frames = DIRECTORY_FRAME.iter_unpack(data[FRAME_SIZE : 16 * FRAME_SIZE])
+
+    for state, file_size, pointer, file_name in frames:
+        frame = DirectoryFrame(state)
 
         # The following information is only available in the first blocks.
         if frame.state == FIRST:
-            frame.file_size = int.from_bytes(data[i + 4 : i + 7], "little")
-            frame.pointer = data[i + 8]
-            frame.file_name = data[i + 10 : i + 31].decode("shift_jis").strip("\x00")
+            # The size is unpacked as a whole 32-bit word, the high byte is unused
+            # so masking it off is all it takes to get the 3 byte value.
+            frame.file_size = file_size & 0xFFFFFF
+            frame.pointer = pointer
+            frame.file_name = decode_shift_jis(file_name)[0].strip("\x00")
 
         directories.append(frame)
 
@@ -92,9 +110,11 @@ def verify_file(data: bytes) -> bool:
     return True
 
 
-def get_title(data: bytes, i: int) -> str:
-    block = read_block(data, i + 1)
-    return block[4:68].decode("shift_jis").strip("\x00")
+def get_title(data: bytes | memoryview, i: int) -> str:
+    # The title lives at 04h-43h of the file's first block, slice only that
+    # out of a view instead of copying the whole block.
+    offset = (i + 1) * BLOCK_SIZE + 4
+    return decode_shift_jis(memoryview(data)[offset : offset + 64])[0].strip("\x00")
 
 
 def main() -> None:
@@ -107,7 +127,8 @@ def main() -> None:
         print("The given file is not a memory card.")
         sys.exit(1)
 
-    directories = parse_header(read_block(data, 0))
+    mv = memoryview(data)
+    directories = parse_header(read_block(mv, 0))
     print("File Name            | Size   | Blocks    | Title")
     total_size = 0
 
@@ -124,7 +145,7 @@ def main() -> None:
                 # Add a space anyway for padding.
                 blocks += " "
 
-            title = get_title(data, i)
+            title = get_title(mv, i)
             total_size += directory.file_size
             print(f"{name} | {size} | {blocks} | {title}")
 
@@ -22,14 +22,19 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 import sys
+import threading
+import weakref
+from functools import lru_cache
 from pathlib import Path
 
 import gi
+import numpy as np
 
 from card_reader import (
     BLOCK_SIZE,
     FIRST,
-    get_title,
+    FRAME_SIZE,
+    decode_shift_jis,
     parse_header,
     read_block,
     verify_file,
@@ -59,79 +64,86 @@ MENU_XML = """
 </interface>
 """
 
+# A list item holding a label, the text is bound straight to a CardEntry property
+# so GTK can update rows without calling back into Python.
+LABEL_XML = """
+<?xml version="1.0" encoding="UTF-8"?>
+<interface>
+  <template class="GtkListItem">
+    <property name="child">
+      <object class="GtkLabel">
+        <property name="halign">start</property>
+        <binding name="label">
+          <lookup name="{prop}" type="CardEntry">
+            <lookup name="item">GtkListItem</lookup>
+          </lookup>
+        </binding>
+      </object>
+    </property>
+  </template>
+</interface>
+"""
+
+# Region flags keyed by the filename prefix (BI = Japan, BE = Europe, BA = America)
+REGIONS = {"BI": "🇯🇵 ", "BE": "🇪🇺 ", "BA": "🇺🇸 "}
+
+# Maps every byte value to its pair of 4-bit palette indexes (low nibble first),
+# icon bitmaps store the left pixel in the low nibble.
+NIBBLE_LUT = np.stack([np.arange(256) & 0xF, np.arange(256) >> 4], axis=1).astype(
+    np.uint8
+)
+
 
-def set_pixel(image_data, x, y, color):
-    pixel_offset = (y * 16 + x) * 3  # Each pixel has 3 bytes (RGB)
-    r, g, b = color
-    # Update the bytes data with the new color
-    image_data[pixel_offset] = r
-    image_data[pixel_offset + 1] = g
-    image_data[pixel_offset + 2] = b
+@lru_cache(maxsize=4)
+def read_card(path, mtime):
+    """
+    Reads the raw card file, reopening a card that hasn't changed skips the disk.
 
+    mtime is only used as part of the cache key so edited files are read again.
+    """
+    return Path(path).read_bytes()
 
-def get_icon(data, i):
-    block = read_block(data, i + 1)
+
+def get_icon(block):
     icon_type = block[2]
 
-    frames = []
-    # First frame.
-    frames.append(block[128:256])
+    # One frame is always present, 0x12 adds a second and 0x13 a third.
+    frame_count = 1
 
-    # Add second frame if available.
-    if icon_type >= 0x12:
-        frames.append(block[256:384])
+    if icon_type >= 0x13:
+        frame_count = 3
+    elif icon_type >= 0x12:
+        frame_count = 2
 
-        # Add third frame if available.
-        if icon_type >= 0x13:
-            frames.append(block[384:512])
+    # The frames are stored back to back right after the palette.
+    frames = block[128 : 128 + frame_count * FRAME_SIZE]
 
     # The raw 16-bit CLUT palette
     palette = block[96:128]
-    # The RGB Palette
-    new_palette = [0] * 16
-
-    red_channel = 0
-    green_channel = 0
-    blue_channel = 0
-    color_counter = 0
-
     # Convert the palette to 8-bit RGB
     # Thanks https://github.com/ShendoXT/memcardrex/blob/master/MemcardRex/GUI/iconWindow.cs#L93
-    for i in range(0, 32, 2):
-        red_channel = (palette[i] & 0x1F) << 3
-        green_channel = ((palette[i + 1] & 0x3) << 6) | ((palette[i] & 0xE0) >> 2)
-        blue_channel = (palette[i + 1] & 0x7C) << 1
-        new_palette[color_counter] = (red_channel, green_channel, blue_channel)
-        color_counter += 1
-
-    # Create the bitmap image representation
-    image_frames = [[0, 0, 0] * 16 * 16]  # First frame.
-
-    # Second frame
-    if icon_type >= 0x12:
-        image_frames.append([0, 0, 0] * 16 * 16)
-
-        # Third frame
-        if icon_type >= 0x13:
-            image_frames.append([0, 0, 0] * 16 * 16)
+    pal = np.frombuffer(palette, dtype=np.uint8).reshape(16, 2)
+    lo = pal[:, 0].astype(np.uint16)
+    hi = pal[:, 1].astype(np.uint16)
 
-    byte_count = 0
-
-    for i, frame in enumerate(frames):
-        byte_count = 0
-        bitmap = image_frames[i]
+    # The RGB Palette
+    new_palette = np.empty((16, 3), dtype=np.uint8)
+    new_palette[:, 0] = (lo & 0x1F) << 3
+    new_palette[:, 1] = ((hi & 0x3) << 6) | ((lo & 0xE0) >> 2)
+    new_palette[:, 2] = (hi & 0x7C) << 1
 
-        for y in range(16):
-            for x in range(0, 16, 2):
-                set_pixel(bitmap, x, y, new_palette[frame[byte_count] & 0xF])
-                set_pixel(bitmap, x + 1, y, new_palette[frame[byte_count] >> 4])
-                byte_count += 1
+    # Create the bitmap image representation of all frames in one go,
+    # giving a (frame_count, 16, 16, 3) RGB array.
+    indexes = NIBBLE_LUT[np.frombuffer(frames, dtype=np.uint8)]
+    image_frames = new_palette[indexes.reshape(frame_count, 16, 16)]
 
     pixbufs = []
 
     for bitmap in image_frames:
-        pixbuf = GdkPixbuf.Pixbuf.new_from_data(
-            bitmap, GdkPixbuf.Colorspace.RGB, False, 8, 16, 16, 48
+        # Rows are packed RGB so the rowstride is 16 * 3 = 48 bytes.
+        buffer = GLib.Bytes.new(bitmap.tobytes())
+        pixbuf = GdkPixbuf.Pixbuf.new_from_bytes(
+            buffer, GdkPixbuf.Colorspace.RGB, False, 8, 16, 16, 48
         )
 
         pixbufs.append(Gdk.Texture.new_for_pixbuf(pixbuf))
@@ -139,79 +151,136 @@ def get_icon(data, i):
     return pixbufs
 
 
+def decode_file(data, i):
+    """Decodes the title and icon of the i-th file, reading its first block once."""
+    # Work on a view of the block, the title, palette and frames are then decoded
+    # without any intermediate copies.
+    block = read_block(memoryview(data), i + 1)
+    title = decode_shift_jis(block[4:68])[0].strip("\x00")
+    return title, get_icon(block)
+
+
+def decode_card(data):
+    """
+    Decodes every file on the card into (icon, name, size, blocks, title) tuples.
+
+    Only creates thread-safe objects (no widgets) so it can run off the main loop.
+    """
+    mv = memoryview(data)
+    files = []
+
+    for i, directory in enumerate(parse_header(read_block(mv, 0))):
+        if directory.state == FIRST:
+            name = directory.file_name
+            size = directory.file_size / 1024
+            blocks = directory.file_size // BLOCK_SIZE
+            title, icon = decode_file(mv, i)
+            files.append((icon, name, size, blocks, title))
+
+    return files
+
+
 class CardEntry(GObject.GObject):
+    # Registered name used by the LABEL_XML lookups.
+    __gtype_name__ = "CardEntry"
+
+    file_name = GObject.Property(type=str)
+    display_name = GObject.Property(type=str)
+    size_str = GObject.Property(type=str)
+    blocks_str = GObject.Property(type=str)
+    title = GObject.Property(type=str)
+
+    # Animated entries with the same update interval share a single timer.
+    # Maps the interval (in ms) to weak references of the entries it drives.
+    animations = {}
+    # Maps the interval (in ms) to the GLib source id of its timer.
+    timers = {}
+
     def __init__(self, pixbufs, file_name, size, blocks, title):
         super().__init__()
 
         self.pixbufs = pixbufs
         self.icon = Gtk.Image.new_from_paintable(self.pixbufs[0])
         self.file_name = file_name
+        self.display_name = REGIONS.get(file_name[:2], "") + file_name
         self.size = size
+        self.size_str = f"{int(size)} KB"
         self.blocks = blocks
+        self.blocks_str = str(blocks)
         self.title = title
-        self.timer_id = None
+        self.update_interval = None
 
         if len(self.pixbufs) > 1:
             self.current_index = 0
             # Start the animation loop
             pal_frame_rate = 25
             pal_frames = 11 if len(self.pixbufs) == 3 else 16
-            update_interval = int((1 / pal_frame_rate) * pal_frames * 1000)
-            self.timer_id = GLib.timeout_add(update_interval, self.update_image)
+            self.update_interval = int((1 / pal_frame_rate) * pal_frames * 1000)
+            self.start_animation()
 
-    def update_image(self):
-        # Update the image source with the next Pixbuf in the list
-        self.icon.set_from_paintable(self.pixbufs[self.current_index])
+    def start_animation(self):
+        entries = CardEntry.animations.get(self.update_interval)
 
-        # Increment index and wrap around if necessary
-        self.current_index = (self.current_index + 1) % len(self.pixbufs)
+        # First entry with this interval, start the shared timer.
+        if entries is None:
+            entries = CardEntry.animations[self.update_interval] = []
+            CardEntry.timers[self.update_interval] = GLib.timeout_add(
+                self.update_interval, CardEntry.update_all, self.update_interval
+            )
 
-        # Continue the animation
-        return True
+        entries.append(weakref.ref(self))
 
-    def do_destroy(self, _):
-        # Clean up
-        if self.timer_id:
-            GLib.source_remove(self.timer_id)
+    def stop_animation(self):
+        entries = CardEntry.animations.get(self.update_interval)
 
+        if entries is None:
+            return
 
-def bind_icon(factory, item):
-    icon = item.get_item().icon
-    item.set_child(icon)
+        entries[:] = [ref for ref in entries if ref() not in (self, None)]
 
+        # That was the last entry using this timer, remove it right away.
+        if not entries:
+            del CardEntry.animations[self.update_interval]
+            GLib.source_remove(CardEntry.timers.pop(self.update_interval))
 
-def bind_name(factory, item):
-    file_name = item.get_item().file_name
-    region = ""
+    @staticmethod
+    def update_all(update_interval):
+        entries = CardEntry.animations[update_interval]
+        # Forget entries that have been stopped or garbage collected.
+        entries[:] = [ref for ref in entries if ref() is not None]
 
-    if file_name.startswith("BI"):
-        region = "🇯🇵 "
-    elif file_name.startswith("BE"):
-        region = "🇪🇺 "
-    elif file_name.startswith("BA"):
-        region = "🇺🇸 "
+        if not entries:
+            # Nothing left to animate, returning False removes the timer.
+            del CardEntry.animations[update_interval]
+            del CardEntry.timers[update_interval]
+            return False
 
-    label = Gtk.Label.new(region + file_name)
-    label.set_halign(Gtk.Align.START)
-    item.set_child(label)
+        for ref in entries:
+            entry = ref()
 
+            if entry is not None:
+                entry.update_image()
 
-def bind_size(factory, item):
-    label = Gtk.Label.new(str(int(item.get_item().size)) + " KB")
-    label.set_halign(Gtk.Align.START)
-    item.set_child(label)
+        # Continue the animation
+        return True
 
+    def update_image(self):
+        # Update the image source with the next Pixbuf in the list
+        self.icon.set_from_paintable(self.pixbufs[self.current_index])
 
-def bind_title(factory, item):
-    label = Gtk.Label.new(item.get_item().title)
-    label.set_halign(Gtk.Align.START)
-    item.set_child(label)
+        # Increment index and wrap around if necessary
+        self.current_index = (self.current_index + 1) % len(self.pixbufs)
 
 
-def bind_blocks(factory, item):
-    label = Gtk.Label.new(str(item.get_item().blocks))
-    label.set_halign(Gtk.Align.START)
-    item.set_child(label)
+def bind_icon(factory, item):
+    icon = item.get_item().icon
+    item.set_child(icon)
+
+
+def label_factory(prop):
+    """Creates a factory for a label bound to the given CardEntry property."""
+    xml = LABEL_XML.format(prop=prop)
+    return Gtk.BuilderListItemFactory.new_from_bytes(None, GLib.Bytes.new(xml.encode()))
 
 
 class PSXWindow(Adw.ApplicationWindow):
@@ -266,6 +335,12 @@ class PSXWindow(Adw.ApplicationWindow):
         self.bin.set_child(self.status_page)
         self.vbox.append(self.bin)
 
+        # The file currently being loaded in the background, if any.
+        self.loading_file = None
+        # Entries of the card on display, stopped when another card replaces them.
+        self.entries = []
+        self.connect("destroy", self.on_destroy)
+
     def on_open(self, widget):
         self.file_chooser = Gtk.FileChooserNative.new(
             "Open File",
@@ -279,66 +354,87 @@ class PSXWindow(Adw.ApplicationWindow):
         self.file_chooser.connect("response", self.on_file)
         self.file_chooser.show()
 
-    def display_card(self, data):
-        directories = parse_header(read_block(data, 0))
+    def display_card(self, files):
         selection = Gtk.SingleSelection()
         store = Gio.ListStore.new(CardEntry)
         selection.set_model(store)
 
-        total_size = 8 * 1024
-
         column_view = Gtk.ColumnView()
         column_view.set_vexpand(True)
 
-        for i, directory in enumerate(directories):
-            if directory.state == FIRST:
-                name = directory.file_name
-                size = directory.file_size / 1024
-                blocks = directory.file_size // BLOCK_SIZE
-                title = get_title(data, i)
-                icon = get_icon(data, i)
-                total_size += directory.file_size
-                entry = CardEntry(icon, name, size, blocks, title)
-                column_view.connect("destroy", entry.do_destroy)
-                store.append(entry)
-
-        def create_column(name, callback):
-            factory = Gtk.SignalListItemFactory()
-            factory.connect("bind", callback)
+        self.stop_animations()
 
+        for icon, name, size, blocks, title in files:
+            entry = CardEntry(icon, name, size, blocks, title)
+            self.entries.append(entry)
+            store.append(entry)
+
+        def create_column(name, factory):
             column = Gtk.ColumnViewColumn.new(name, factory)
             column.set_expand(True)
             column_view.append_column(column)
 
-        create_column("Icon", bind_icon)
-        create_column("File Name", bind_name)
-        create_column("Size", bind_size)
-        create_column("Blocks", bind_blocks)
-        create_column("Title", bind_title)
+        icon_factory = Gtk.SignalListItemFactory()
+        icon_factory.connect("bind", bind_icon)
+
+        create_column("Icon", icon_factory)
+        create_column("File Name", label_factory("display-name"))
+        create_column("Size", label_factory("size-str"))
+        create_column("Blocks", label_factory("blocks-str"))
+        create_column("Title", label_factory("title"))
 
         column_view.set_model(selection)
         self.bin.set_child(column_view)
 
+    def stop_animations(self):
+        for entry in self.entries:
+            entry.stop_animation()
+
+        self.entries = []
+
+    def on_destroy(self, widget):
+        # Clean up
+        self.stop_animations()
+
     def on_file(self, widget, response):
         if response == Gtk.ResponseType.ACCEPT:
             file = self.file_chooser.get_file()
+            self.loading_file = file
+
+            # Read and decode the card in the background so the window stays responsive.
+            thread = threading.Thread(target=self.load_card, args=(file,), daemon=True)
+            thread.start()
+
+    def load_card(self, file):
+        # Runs in a worker thread, widgets must only be touched in on_card_loaded.
+        # TODO: Find out how to do this via GFile
+        path = file.get_path()
+        data = read_card(path, Path(path).stat().st_mtime_ns)
+
+        # Verify if the card is good.
+        files = decode_card(data) if verify_file(data) else None
+        GLib.idle_add(self.on_card_loaded, file, files)
+
+    def on_card_loaded(self, file, files):
+        # Another file was opened while this one was loading.
+        if file is not self.loading_file:
+            return False
+
+        if files is None:
+            dialog = Adw.MessageDialog.new(
+                self,
+                "Invalid Memory Card",
+                "File is not a correct memory card or was corrupted",
+            )
+            dialog.add_response("ok", "Okay")
+            dialog.show()
+        else:
+            # Update titlebar to reflect the current open file.
+            self.titlebar.set_subtitle(file.get_basename())
+            self.display_card(files)
 
-            # TODO: Find out how to do this via GFile
-            data = Path(file.get_path()).read_bytes()
-
-            # Verify if the card is good.
-            if not verify_file(data):
-                dialog = Adw.MessageDialog.new(
-                    self,
-                    "Invalid Memory Card",
-                    "File is not a correct memory card or was corrupted",
-                )
-                dialog.add_response("ok", "Okay")
-                dialog.show()
-            else:
-                # Update titlebar to reflect the current open file.
-                self.titlebar.set_subtitle(file.get_basename())
-                self.display_card(data)
+        # Run only once.
+        return False
 
 
 class PSXCardReader(Adw.Application):